@@ -662,12 +662,15 @@ class Reader(object):
                      'shuffle_row_drop_partition': (shuffle_row_drop_partition,
                                                     shuffle_row_drop_partitions)})
 
+        # A user supplied reader_pool might not implement batched ventilation
+        ventilate_many_fn = getattr(self._workers_pool, 'ventilate_many', None)
         return ConcurrentVentilator(self._workers_pool.ventilate,
                                     items_to_ventilate,
                                     iterations=num_epochs,
                                     max_ventilation_queue_size=max_ventilation_queue_size,
                                     randomize_item_order=shuffle_row_groups,
-                                    random_seed=seed)
+                                    random_seed=seed,
+                                    ventilate_many_fn=ventilate_many_fn)
 
     def stop(self):
         """Stops all worker threads/processes."""
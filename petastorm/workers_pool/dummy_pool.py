@@ -47,6 +47,10 @@ class DummyPool(object):
         """Send a work item to a worker process."""
         self._ventilator_queue.append((args, kargs))
 
+    def ventilate_many(self, items):
+        """Send a batch of work items to a worker process. Each item is a ``dict`` of ``**kwargs``."""
+        self._ventilator_queue.extend(((), item) for item in items)
+
     def get_results(self):
         """Returns results
 
@@ -223,6 +223,11 @@ class ProcessPool(object):
                                        lambda: self._ventilator_send.send_pyobj((args, kargs),
                                                                                 flags=zmq.constants.NOBLOCK))
 
+    def ventilate_many(self, items):
+        """Sends a batch of work items to worker processes. Each item is a ``dict`` of ``**kwargs``."""
+        for item in items:
+            self.ventilate(**item)
+
     def get_results(self):
         """Returns results from worker pool
 
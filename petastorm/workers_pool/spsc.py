@@ -0,0 +1,130 @@
+#  Copyright (c) 2017-2018 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+from threading import Event, Lock
+from time import monotonic
+
+from six.moves import queue
+
+
+class SPSCQueue(object):
+    """A single-producer/single-consumer queue with a subset of the :class:`queue.Queue` interface.
+
+    ``deque.append`` and ``deque.popleft`` are atomic, so as long as there is exactly one producer and one consumer
+    thread, items can be passed without taking a lock. An :class:`threading.Event` is touched only when the consumer
+    finds the queue empty (or the producer finds it full) and has to block.
+
+    Besides the producer, other threads may occasionally put out-of-band items (e.g. wakeup tokens) with
+    ``put(item, block=False)``. These never block, but racing with the producer's ``put``, the queue may exceed
+    ``maxsize`` by one item per such call. Likewise, another thread may drain the queue with ``get(block=False)``;
+    a consumer blocked in ``get`` keeps waiting if the drain took the item it was woken up for.
+    """
+
+    def __init__(self, maxsize=0):
+        """
+        :param maxsize: Maximal number of items in the queue. ``put`` blocks while the queue is full. If ``maxsize``
+          is less than or equal to zero, the queue size is unbounded.
+        """
+        self.maxsize = maxsize
+        self._items = deque()
+        self._not_empty = Event()
+        self._not_full = Event()
+
+    def put(self, item, block=True, timeout=None):
+        """Puts an item into the queue. Raises :class:`queue.Full` if no free slot became available within
+        ``timeout`` (or immediately, if ``block`` is ``False``)."""
+        if self.maxsize > 0 and len(self._items) >= self.maxsize:
+            self._wait(self._not_full, lambda: len(self._items) < self.maxsize, block, timeout, queue.Full)
+        self._items.append(item)
+        if not self._not_empty.is_set():
+            self._not_empty.set()
+
+    def put_many(self, items):
+        """Appends all ``items`` to the queue at once, waking up the consumer a single time. ``maxsize`` is not
+        enforced, hence this should be used with unbounded queues."""
+        self._items.extend(items)
+        if self._items and not self._not_empty.is_set():
+            self._not_empty.set()
+
+    def get(self, block=True, timeout=None):
+        """Removes and returns an item from the queue. Raises :class:`queue.Empty` if no item became available within
+        ``timeout`` (or immediately, if ``block`` is ``False``)."""
+        while True:
+            try:
+                item = self._items.popleft()
+                break
+            except IndexError:
+                # Items might be taken by another thread draining the queue (e.g. when a worker pool is stopped)
+                # between the wakeup and the popleft, hence the retry
+                self._wait(self._not_empty, lambda: self._items, block, timeout, queue.Empty)
+        if self.maxsize > 0 and not self._not_full.is_set():
+            self._not_full.set()
+        return item
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    def _wait(self, event, ready, block, timeout, exception_type):
+        """Blocks on ``event`` until ``ready()`` is true. The event is cleared before ``ready()`` is re-evaluated, so
+        a wakeup issued by the other side in between can not be lost."""
+        if not block:
+            raise exception_type()
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            event.clear()
+            if ready():
+                return
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                raise exception_type()
+            event.wait(remaining)
+
+
+class MPSCQueue(SPSCQueue):
+    """A multi-producer/single-consumer variant of :class:`SPSCQueue`.
+
+    Producers are serialized with a lock so the ``maxsize`` check and the append are atomic with respect to each other.
+    The consumer side is the same as in :class:`SPSCQueue` and does not take the lock.
+    """
+
+    def __init__(self, maxsize=0):
+        super(MPSCQueue, self).__init__(maxsize)
+        self._put_lock = Lock()
+
+    def put(self, item, block=True, timeout=None):
+        if not block or timeout is None:
+            acquired = self._put_lock.acquire(block)
+        else:
+            # The timeout applies to the whole call: the time spent waiting for the lock is not waited again for a
+            # free slot
+            deadline = monotonic() + timeout
+            acquired = self._put_lock.acquire(True, timeout)
+            timeout = max(0, deadline - monotonic())
+        if not acquired:
+            raise queue.Full()
+        try:
+            super(MPSCQueue, self).put(item, block, timeout)
+        finally:
+            self._put_lock.release()
+
+    def put_many(self, items):
+        """Puts all ``items`` into the queue, blocking while it is full. Unlike :func:`SPSCQueue.put_many`,
+        ``maxsize`` is enforced. Items put by other producers are not interleaved with ``items``."""
+        with self._put_lock:
+            for item in items:
+                super(MPSCQueue, self).put(item)
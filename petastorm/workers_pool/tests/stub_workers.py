@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 from time import sleep
 
 from petastorm.workers_pool.worker_base import WorkerBase
@@ -33,6 +34,22 @@ class IdentityWorker(WorkerBase):
         self.publish_func(kargs['item'])
 
 
+class SleepyIdentityWorker(WorkerBase):
+    def process(self, *args, **kargs):
+        sleep(kargs['sleep'])
+        self.publish_func(kargs['item'])
+
+
+class ArgsReportingWorker(WorkerBase):
+    def process(self, *args, **kargs):
+        self.publish_func((args, kargs))
+
+
+class CpuAffinityReportingWorker(WorkerBase):
+    def process(self, *args, **kargs):
+        self.publish_func(os.sched_getaffinity(0))
+
+
 class WorkerIdGeneratingWorker(WorkerBase):
     def process(self, *args, **kargs):
         self.publish_func(self.worker_id)
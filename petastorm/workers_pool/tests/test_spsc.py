@@ -0,0 +1,131 @@
+#  Copyright (c) 2017-2018 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+from threading import Thread
+
+from six.moves import queue
+
+from petastorm.workers_pool.spsc import MPSCQueue, SPSCQueue
+
+
+class TestSPSCQueue(unittest.TestCase):
+
+    def test_fifo_order(self):
+        q = SPSCQueue()
+        for i in range(10):
+            q.put(i)
+        self.assertEqual(10, q.qsize())
+        self.assertEqual(list(range(10)), [q.get() for _ in range(10)])
+        self.assertTrue(q.empty())
+
+    def test_get_from_empty_queue(self):
+        q = SPSCQueue()
+        with self.assertRaises(queue.Empty):
+            q.get(block=False)
+        with self.assertRaises(queue.Empty):
+            q.get(timeout=0.01)
+
+    def test_put_to_full_queue(self):
+        q = SPSCQueue(2)
+        q.put(0)
+        q.put(1)
+        with self.assertRaises(queue.Full):
+            q.put(2, block=False)
+        with self.assertRaises(queue.Full):
+            q.put(2, timeout=0.01)
+        self.assertEqual(0, q.get())
+        q.put(2, block=False)
+        self.assertEqual([1, 2], [q.get(), q.get()])
+
+    def test_producer_consumer_threads(self):
+        """A bounded queue passes all items between two threads without losing or reordering them"""
+        ITEMS_COUNT = 10000
+        q = SPSCQueue(3)
+
+        def produce():
+            for i in range(ITEMS_COUNT):
+                q.put(i)
+
+        producer = Thread(target=produce)
+        producer.start()
+        received = [q.get(timeout=10) for _ in range(ITEMS_COUNT)]
+        producer.join()
+
+        self.assertEqual(list(range(ITEMS_COUNT)), received)
+
+
+class TestMPSCQueue(unittest.TestCase):
+
+    def test_multiple_producers(self):
+        """Items from all producers are received, each producer's items in the order they were put"""
+        PRODUCERS_COUNT = 4
+        ITEMS_COUNT = 2000
+        q = MPSCQueue(5)
+        observed_sizes = []
+
+        def produce(producer_id):
+            for i in range(ITEMS_COUNT):
+                q.put((producer_id, i))
+                observed_sizes.append(q.qsize())
+
+        producers = [Thread(target=produce, args=(producer_id,)) for producer_id in range(PRODUCERS_COUNT)]
+        for producer in producers:
+            producer.start()
+        received = [q.get(timeout=10) for _ in range(PRODUCERS_COUNT * ITEMS_COUNT)]
+        for producer in producers:
+            producer.join()
+
+        for producer_id in range(PRODUCERS_COUNT):
+            self.assertEqual(list(range(ITEMS_COUNT)), [i for p, i in received if p == producer_id])
+        self.assertLessEqual(max(observed_sizes), 5)
+
+    def test_put_to_full_queue(self):
+        q = MPSCQueue(1)
+        q.put(0)
+        with self.assertRaises(queue.Full):
+            q.put(1, block=False)
+        with self.assertRaises(queue.Full):
+            q.put(1, timeout=0.01)
+
+    def test_put_timeout_includes_waiting_for_other_producers(self):
+        """The put timeout bounds the whole call, including the time waiting for another blocked producer"""
+        q = MPSCQueue(1)
+        q.put(0)
+        # Holds the producers lock while waiting for a free slot, until it gives up after 0.5 s
+        other_producer = Thread(target=self.assertRaises, args=(queue.Full, q.put, 1), kwargs={'timeout': 0.5})
+        other_producer.start()
+        time.sleep(0.05)
+
+        tic = time.time()
+        with self.assertRaises(queue.Full):
+            q.put(2, timeout=0.6)
+        self.assertLess(time.time() - tic, 0.9)
+        other_producer.join()
+
+    def test_put_many_enforces_maxsize(self):
+        q = MPSCQueue(2)
+        producer = Thread(target=q.put_many, args=([0, 1, 2, 3],))
+        producer.start()
+        time.sleep(0.05)
+        self.assertEqual(2, q.qsize())
+
+        self.assertEqual([0, 1, 2, 3], [q.get(timeout=10) for _ in range(4)])
+        producer.join()
+
+
+if __name__ == '__main__':
+    # Delegate to the test framework.
+    unittest.main()
@@ -15,13 +15,47 @@
 
 import time
 import unittest
+from threading import Thread
 
 from petastorm.workers_pool import EmptyResultError
 from petastorm.workers_pool.dummy_pool import DummyPool
 from petastorm.workers_pool.process_pool import ProcessPool
 from petastorm.workers_pool.tests.stub_workers import IdentityWorker
 from petastorm.workers_pool.thread_pool import ThreadPool
-from petastorm.workers_pool.ventilator import ConcurrentVentilator
+from petastorm.workers_pool.ventilator import ConcurrentVentilator, Ventilator
+
+
+class ThreadedListVentilator(Ventilator):
+    """A minimal ventilator that ventilates a list of items from its own thread. Unlike
+    :class:`ConcurrentVentilator`, it does not call the completion callback."""
+
+    def __init__(self, ventilate_fn, items_to_ventilate):
+        super(ThreadedListVentilator, self).__init__(ventilate_fn)
+        self._items_to_ventilate = items_to_ventilate
+        self._completed = False
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._ventilate)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _ventilate(self):
+        for item in self._items_to_ventilate:
+            self._ventilate_fn(**item)
+            # Lets the consumer catch up with the ventilated items before the ventilator completes
+            time.sleep(0.05)
+        self._completed = True
+
+    def processed_item(self):
+        pass
+
+    def completed(self):
+        return self._completed
+
+    def stop(self):
+        if self._thread:
+            self._thread.join()
 
 
 class TestWorkersPool(unittest.TestCase):
@@ -48,6 +82,24 @@ class TestWorkersPool(unittest.TestCase):
     def test_ventilator_dummy(self):
         self._test_simple_ventilation(DummyPool)
 
+    def test_ventilate_many(self):
+        """Batched ventilation delivers every item exactly once and preserves the round robin order"""
+        items_to_ventilate = [{'item': i} for i in range(50)]
+        for pool, ordered in [(DummyPool(), True), (ThreadPool(1), True), (ThreadPool(10), True),
+                              (ThreadPool(10, shuffle_rows=True), False), (ProcessPool(3), False)]:
+            ventilator = ConcurrentVentilator(ventilate_fn=pool.ventilate, items_to_ventilate=items_to_ventilate,
+                                              max_ventilation_queue_size=7, ventilate_many_fn=pool.ventilate_many)
+            pool.start(IdentityWorker, ventilator=ventilator)
+
+            all_results = [pool.get_results() for _ in items_to_ventilate]
+            expected = [i['item'] for i in items_to_ventilate]
+            self.assertEqual(expected, all_results if ordered else sorted(all_results))
+            with self.assertRaises(EmptyResultError):
+                pool.get_results()
+
+            pool.stop()
+            pool.join()
+
     def test_max_ventilation_size(self):
         """Tests that we dont surpass a max ventilation size in each pool type
         (since it relies on accurate ventilation size reporting)"""
@@ -74,6 +126,26 @@ class TestWorkersPool(unittest.TestCase):
             pool.stop()
             pool.join()
 
+    def test_processed_item_wakes_up_ventilation(self):
+        """A full ventilation queue is refilled as soon as an item is processed, not after ventilation_interval"""
+        for pool in [DummyPool(), ThreadPool(2)]:
+            ventilator = ConcurrentVentilator(ventilate_fn=pool.ventilate,
+                                              items_to_ventilate=[{'item': i} for i in range(5)],
+                                              max_ventilation_queue_size=1, ventilation_interval=10)
+            pool.start(IdentityWorker, ventilator=ventilator)
+
+            tic = time.time()
+            self.assertEqual(list(range(5)), [pool.get_results() for _ in range(5)])
+            self.assertLess(time.time() - tic, 5)
+
+            with self.assertRaises(EmptyResultError):
+                pool.get_results()
+
+            tic = time.time()
+            pool.stop()
+            pool.join()
+            self.assertLess(time.time() - tic, 5)
+
     def test_reset_in_the_middle_of_ventilation(self):
         """Can not reset ventilator in the middle of ventilation"""
         for pool in [DummyPool(), ThreadPool(10)]:
@@ -171,6 +243,83 @@ class TestWorkersPool(unittest.TestCase):
         pool.stop()
         pool.join()
 
+    def test_ventilator_stop_wakes_up_waiting_get_results(self):
+        """get_results blocked waiting for the next item to be ventilated returns once the ventilator is stopped"""
+        for pool in [ThreadPool(1), ThreadPool(2), ThreadPool(2, shuffle_rows=True)]:
+            # A single item in flight with a long ventilation interval: get_results mostly waits for the ventilator
+            ventilator = ConcurrentVentilator(ventilate_fn=pool.ventilate,
+                                              items_to_ventilate=[{'item': i} for i in range(10)],
+                                              iterations=None, max_ventilation_queue_size=1,
+                                              ventilation_interval=0.05)
+            pool.start(IdentityWorker, ventilator=ventilator)
+
+            raised = []
+
+            def get_results():
+                try:
+                    while True:
+                        pool.get_results()
+                except EmptyResultError:
+                    raised.append(True)
+
+            reader = Thread(target=get_results)
+            reader.start()
+            time.sleep(0.2)
+            ventilator.stop()
+            reader.join(timeout=5)
+
+            self.assertFalse(reader.is_alive())
+            self.assertEqual([True], raised)
+
+            pool.stop()
+            pool.join()
+
+    def test_ventilator_without_completion_callback(self):
+        """get_results finds out that a ventilator completed even if it does not call the completion callback"""
+        for pool in [ThreadPool(1), ThreadPool(2), ThreadPool(2, shuffle_rows=True)]:
+            ventilator = ThreadedListVentilator(pool.ventilate, [{'item': i} for i in range(3)])
+            pool.start(IdentityWorker, ventilator=ventilator)
+
+            raised = []
+            results = []
+
+            def get_results():
+                try:
+                    while True:
+                        results.append(pool.get_results())
+                except EmptyResultError:
+                    raised.append(True)
+
+            reader = Thread(target=get_results)
+            reader.daemon = True
+            reader.start()
+            reader.join(timeout=5)
+
+            self.assertFalse(reader.is_alive())
+            self.assertEqual([True], raised)
+            self.assertEqual([0, 1, 2], sorted(results))
+
+            pool.stop()
+            pool.join()
+
+    def test_completion_callback(self):
+        """The completion callback is called once all the items were ventilated"""
+        pool = DummyPool()
+        ventilator = ConcurrentVentilator(ventilate_fn=pool.ventilate,
+                                          items_to_ventilate=[{'item': i} for i in range(10)], iterations=2)
+        completions = []
+        ventilator.set_completion_callback(lambda: completions.append(ventilator.completed()))
+        pool.start(IdentityWorker, ventilator=ventilator)
+
+        self.assertEqual(20, len([pool.get_results() for _ in range(20)]))
+        with self.assertRaises(EmptyResultError):
+            pool.get_results()
+        ventilator.stop()
+        self.assertEqual([True], completions)
+
+        pool.stop()
+        pool.join()
+
     def test_randomize_item_order(self):
         size = 100
         pool = DummyPool()
@@ -199,6 +348,23 @@ class TestWorkersPool(unittest.TestCase):
         pool.stop()
         pool.join()
 
+    def test_randomize_item_order_with_seed(self):
+        """The same random_seed results in the same permutation of the items"""
+        size = 100
+        all_results = []
+        for _ in range(2):
+            pool = DummyPool()
+            ventilator = ConcurrentVentilator(pool.ventilate, items_to_ventilate=[{'item': i} for i in range(size)],
+                                              randomize_item_order=True, random_seed=123)
+            pool.start(IdentityWorker, ventilator=ventilator)
+            all_results.append([pool.get_results() for _ in range(size)])
+            pool.stop()
+            pool.join()
+
+        self.assertEqual(all_results[0], all_results[1])
+        self.assertEqual(list(range(size)), sorted(all_results[0]))
+        self.assertNotEqual(list(range(size)), all_results[0])
+
 
 if __name__ == '__main__':
     # Delegate to the test framework.
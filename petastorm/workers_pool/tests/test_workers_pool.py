@@ -13,8 +13,11 @@
 # limitations under the License.
 
 
+import os
 import time
 import unittest
+from collections import OrderedDict
+from threading import Thread
 
 import numpy as np
 from multiprocessing import Process, Manager
@@ -24,9 +27,10 @@ from psutil import pid_exists
 from petastorm.workers_pool import EmptyResultError
 from petastorm.workers_pool.dummy_pool import DummyPool
 from petastorm.workers_pool.process_pool import ProcessPool
-from petastorm.workers_pool.tests.stub_workers import CoeffMultiplierWorker, \
-    WorkerIdGeneratingWorker, WorkerMultiIdGeneratingWorker, SleepyWorkerIdGeneratingWorker, \
-    ExceptionGeneratingWorker_5, PreprogrammedReturnValueWorker
+from petastorm.workers_pool.tests.stub_workers import ArgsReportingWorker, CoeffMultiplierWorker, \
+    CpuAffinityReportingWorker, WorkerIdGeneratingWorker, WorkerMultiIdGeneratingWorker, \
+    SleepyWorkerIdGeneratingWorker, ExceptionGeneratingWorker_5, PreprogrammedReturnValueWorker, \
+    SleepyIdentityWorker, SleepyDoingNothingWorker
 from petastorm.workers_pool.thread_pool import ThreadPool
 
 
@@ -55,6 +59,9 @@ class TestWorkersPool(unittest.TestCase):
     def test_passing_args_threads(self):
         self._passing_args_impl(lambda: ThreadPool(10))
 
+    def test_passing_args_threads_shared_results_queue(self):
+        self._passing_args_impl(lambda: ThreadPool(10, shuffle_rows=True))
+
     def test_passing_args_dummy(self):
         self._passing_args_impl(DummyPool)
 
@@ -163,6 +170,104 @@ class TestWorkersPool(unittest.TestCase):
         pool.stop()
         pool.join()
 
+    def test_thread_pool_passes_positional_and_keyword_args(self):
+        """Items ventilated with keyword arguments only are queued as dicts, others as (args, kargs) tuples"""
+        pool = ThreadPool(2)
+        pool.start(ArgsReportingWorker)
+        pool.ventilate(1, 2, a=3)
+        pool.ventilate(a=4)
+        pool.ventilate()
+        # dict subclasses are kwargs as well, even with two keys (which could be mistaken for an (args, kargs) tuple)
+        pool.ventilate_many([{'b': 5}, {}, OrderedDict(c=6), OrderedDict(d=7, e=8)])
+
+        expected = [((1, 2), {'a': 3}), ((), {'a': 4}), ((), {}), ((), {'b': 5}), ((), {}), ((), {'c': 6}),
+                    ((), {'d': 7, 'e': 8})]
+        self.assertEqual(expected, [pool.get_results() for _ in expected])
+
+        pool.stop()
+        pool.join()
+
+    def test_thread_pool_diagnostics(self):
+        pool = ThreadPool(2)
+        pool.start(WorkerIdGeneratingWorker)
+        for _ in range(4):
+            pool.ventilate()
+
+        # Each item produces a result followed by a VentilatedItemProcessedMessage
+        deadline = time.time() + 5
+        while pool.results_qsize() < 8 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(8, pool.results_qsize(), msg='Timeout while waiting for the workers to publish the results')
+        diags = pool.diagnostics
+        self.assertEqual([4, 4], diags['per_worker_ready'])
+        self.assertEqual([0, 0], diags['per_worker_pending'])
+        self.assertEqual(4, diags['items_inprocess'])
+
+        self.assertEqual([0, 1, 0, 1], [pool.get_results() for _ in range(4)])
+        with self.assertRaises(EmptyResultError):
+            pool.get_results()
+        diags = pool.diagnostics
+        self.assertEqual({'output_queue_size': 0, 'items_consumed': 4, 'items_produced': 4, 'items_inprocess': 0,
+                          'per_worker_pending': [0, 0], 'per_worker_ready': [0, 0]}, diags)
+
+        pool.stop()
+        pool.join()
+
+    def test_stop_unblocks_get_results(self):
+        """get_results waiting for a slow worker in another thread returns once the pool is stopped"""
+        for pool in [ThreadPool(2), ThreadPool(2, shuffle_rows=True), ThreadPool(1)]:
+            pool.start(SleepyDoingNothingWorker, 10)
+            pool.ventilate()
+
+            raised = []
+
+            def get_results():
+                try:
+                    pool.get_results()
+                except EmptyResultError:
+                    raised.append(True)
+
+            reader = Thread(target=get_results)
+            reader.start()
+            time.sleep(0.1)
+            pool.stop()
+            reader.join(timeout=5)
+
+            self.assertFalse(reader.is_alive())
+            self.assertEqual([True], raised)
+
+    def test_stop_unblocks_workers_on_full_results_queue(self):
+        """Workers blocked publishing to a full results queue terminate once the pool is stopped"""
+        for pool in [ThreadPool(2, results_queue_size=2), ThreadPool(2, shuffle_rows=True, results_queue_size=2),
+                     ThreadPool(1, results_queue_size=2)]:
+            pool.start(CoeffMultiplierWorker, {'coeff': 1})
+            for _ in range(4):
+                pool.ventilate(value=list(range(100)))
+            self.assertEqual(0, pool.get_results())
+            # Give the workers time to fill up the results queues
+            time.sleep(0.1)
+
+            pool.stop()
+            joiner = Thread(target=pool.join)
+            joiner.start()
+            joiner.join(timeout=5)
+            self.assertFalse(joiner.is_alive())
+
+    @unittest.skipUnless(hasattr(os, 'sched_setaffinity'), 'Pinning threads to CPUs is supported only on Linux')
+    def test_thread_pool_pin_to_cpus(self):
+        """Worker threads are pinned to the requested CPUs, while the calling thread is not affected"""
+        available_cpus = sorted(os.sched_getaffinity(0))
+        pool = ThreadPool(2, pin_to_cpus=available_cpus[:1])
+        pool.start(CpuAffinityReportingWorker)
+        pool.ventilate()
+        pool.ventilate()
+
+        self.assertEqual([{available_cpus[0]}] * 2, [pool.get_results(), pool.get_results()])
+        self.assertEqual(available_cpus, sorted(os.sched_getaffinity(0)))
+
+        pool.stop()
+        pool.join()
+
     def test_dummy_pool_should_process_tasks_in_fifo_order(self):
         """Check that the dummy pool processes in fifo order"""
         pool = DummyPool()
@@ -186,6 +291,55 @@ class TestWorkersPool(unittest.TestCase):
 
         self.assertEqual(actual_output, [0, 1, 2, 3, 4])
 
+    def test_thread_pool_preserves_ventilation_order(self):
+        """Results are returned in the ventilation order when the pool is created without shuffle_rows"""
+        for workers_count in [1, 4]:
+            pool = ThreadPool(workers_count, results_queue_size=4)
+            pool.start(CoeffMultiplierWorker, {'coeff': 1})
+
+            expected_output = []
+            for i in range(100):
+                value = [i * 10 + j for j in range(i % 3)]
+                expected_output.extend(value)
+                pool.ventilate(message='dummy message', value=value)
+
+            actual_output = []
+            with self.assertRaises(EmptyResultError):
+                while True:
+                    actual_output.append(pool.get_results())
+            self.assertEqual(expected_output, actual_output)
+
+            pool.stop()
+            pool.join()
+
+    def test_thread_pool_ventilate_many_continues_round_robin(self):
+        """ventilate_many assigns items to workers as if ventilate was called for each of them"""
+        pool = ThreadPool(3)
+        pool.start(WorkerIdGeneratingWorker)
+
+        pool.ventilate()
+        pool.ventilate_many([{}] * 7)
+
+        self.assertEqual([0, 1, 2, 0, 1, 2, 0, 1], [pool.get_results() for _ in range(8)])
+        pool.stop()
+        pool.join()
+
+    def test_thread_pool_preserves_ventilation_order_with_slow_worker(self):
+        """Results published by the other workers while waiting on a slow worker are returned in order"""
+        pool = ThreadPool(3, results_queue_size=3)
+        pool.start(SleepyIdentityWorker)
+
+        pool.ventilate(item=0, sleep=0.5)
+        for i in range(1, 60):
+            pool.ventilate(item=i, sleep=0)
+
+        self.assertEqual(list(range(60)), [pool.get_results() for _ in range(60)])
+        with self.assertRaises(EmptyResultError):
+            pool.get_results()
+
+        pool.stop()
+        pool.join()
+
     def _test_exception_in_worker_impl(self, pool, num_to_ventilate):
         """ Test exception handler in worker. Pool should be terminated """
         # exception should be propagated to calling thread
@@ -13,20 +13,33 @@
 # limitations under the License.
 
 import cProfile
+import logging
+import os
 import pstats
-import sys
+from collections import deque
 from threading import Thread, Event
-from traceback import format_exc
 
 from six.moves import queue
 
 from petastorm.workers_pool import EmptyResultError, VentilatedItemProcessedMessage
+from petastorm.workers_pool.spsc import MPSCQueue, SPSCQueue
 
-# Defines how frequently will we check the stop event while waiting on a blocking queue
+# Defines how frequently join() drains the results queues while waiting for the worker threads to terminate
 IO_TIMEOUT_INTERVAL_S = 0.001
-# Amount of time we will wait on a the queue to get the next result. If no results received until then, we will
-# recheck if no more items are expected to be ventilated
+# Posted by ThreadPool.stop() to the ventilator queues, to wake up workers blocked waiting for the next item, and to
+# the shared results queue, to wake up a get_results call blocked waiting for the next result
+_STOP = object()
+# Posted to the results queue get_results is waiting on once the ventilator completes. get_results then rechecks
+# whether more results are expected. A stale _EOF (read while items are still pending) is ignored.
+_EOF = object()
+# Only ConcurrentVentilator calls the completion callback posting _EOF. Once all the ventilated items were consumed,
+# get_results rechecks whether the ventilator completed at least this often (in seconds), so it does not block forever
+# with a ventilator that does not
 _VERIFY_END_OF_VENTILATION_PERIOD = 0.1
+# Published by a worker after all the results of an item. The message carries no state, so a single instance is reused
+_VENTILATED_ITEM_PROCESSED = VentilatedItemProcessedMessage()
+
+logger = logging.getLogger(__name__)
 
 
 class WorkerTerminationRequested(Exception):
@@ -37,45 +50,70 @@ class WorkerThread(Thread):
     """Thread class with a stop() method. The thread itself has to check
     regularly for the stopped() condition."""
 
-    def __init__(self, worker_impl, stop_event, ventilator_queue, results_queue, profiling_enabled=False):
+    def __init__(self, worker_impl, stop_event, ventilator_queue, profiling_enabled=False, cpu=None):
         super(WorkerThread, self).__init__()
         self._stop_event = stop_event
         self._worker_impl = worker_impl
         self._ventilator_queue = ventilator_queue
-        self._results_queue = results_queue
         self._profiling_enabled = profiling_enabled
+        self._cpu = cpu
         if profiling_enabled:
             self.prof = cProfile.Profile()
 
     def run(self):
+        if self._cpu is not None:
+            self._pin_to_cpu()
         if self._profiling_enabled:
             self.prof.enable()
+        # The callables used for every item are looked up once
+        get = self._ventilator_queue.get
+        stop_requested = self._stop_event.is_set
+        process = self._worker_impl.process
+        publish_func = self._worker_impl.publish_func
         # Loop and accept messages from both channels, acting accordingly
         while True:
+            # Block until the next item is ventilated. ThreadPool.stop() posts _STOP to wake us up.
+            item = get()
             # Check for stop event first to prevent erroneous reuse
-            if self._stop_event.is_set():
+            if item is _STOP or stop_requested():
                 break
-            # If the message came from work_receiver channel
             try:
-                (args, kargs) = self._ventilator_queue.get(block=True, timeout=IO_TIMEOUT_INTERVAL_S)
-                self._worker_impl.process(*args, **kargs)
-                self._worker_impl.publish_func(VentilatedItemProcessedMessage())
-            except queue.Empty:
-                pass
+                # Items ventilated with keyword arguments only (the common case) are queued as the kwargs dict (or
+                # any dict subclass passed to ventilate_many)
+                if isinstance(item, dict):
+                    process(**item)
+                else:
+                    (args, kargs) = item
+                    process(*args, **kargs)
+                publish_func(_VENTILATED_ITEM_PROCESSED)
             except WorkerTerminationRequested:
                 pass
             except Exception as e:  # pylint: disable=broad-except
-                stderr_message = 'Worker %d terminated: unexpected exception:\n' % self._worker_impl.worker_id
-                stderr_message += format_exc()
-                sys.stderr.write(stderr_message)
-                self._results_queue.put(e)
+                logger.error('Worker %d terminated: unexpected exception', self._worker_impl.worker_id, exc_info=True)
+                try:
+                    publish_func(e)
+                except WorkerTerminationRequested:
+                    pass
                 break
         if self._profiling_enabled:
             self.prof.disable()
 
+    def _pin_to_cpu(self):
+        # On Linux, pid 0 refers to the calling thread, so only this worker thread is pinned
+        if not hasattr(os, 'sched_setaffinity'):
+            logger.warning('Worker %d: pinning threads to CPUs is not supported on this platform',
+                           self._worker_impl.worker_id)
+            return
+        try:
+            os.sched_setaffinity(0, {self._cpu})
+        except OSError:
+            logger.warning('Worker %d: failed pinning the thread to CPU %d', self._worker_impl.worker_id, self._cpu,
+                           exc_info=True)
+
 
 class ThreadPool(object):
-    def __init__(self, workers_count, results_queue_size=50, profiling_enabled=False, shuffle_rows=False, seed=None):
+    def __init__(self, workers_count, results_queue_size=50, profiling_enabled=False, shuffle_rows=False, seed=None,
+                 pin_to_cpus=None):
         """Initializes a thread pool.
 
         TODO: consider using a standard thread pool
@@ -86,25 +124,39 @@ class ThreadPool(object):
 
         :param workers_count: Number of threads
         :param profile: Whether to run a profiler on the threads
+        :param pin_to_cpus: Optional list of CPU ids. If set, worker ``i`` is pinned to CPU
+          ``pin_to_cpus[i % len(pin_to_cpus)]`` (Linux only), keeping the data it processes hot in that CPU caches.
         """
         self._seed = seed
         self._shuffle_rows = shuffle_rows
         self._workers = []
         self._ventilator_queues = []
+        self._results_queues = []
         self.workers_count = workers_count
         self._results_queue_size = results_queue_size
         # Worker threads will watch this event and gracefully shutdown when the event is set
         self._stop_event = Event()
         self._profiling_enabled = profiling_enabled
+        self._pin_to_cpus = list(pin_to_cpus) if pin_to_cpus else None
 
         # Count of items ventilated by the pool
         self._ventilated_items = 0
         # Count of items ventilated by each worker
         self._ventilated_items_by_worker = [0 for _ in range(self.workers_count)]
+        # Count of items processed by the pool (i.e. all their results were consumed by get_results)
+        self._ventilated_items_processed = 0
         # Count of items processed by each worker
         self._ventilated_items_processed_by_worker = [0 for _ in range(self.workers_count)]
         self._ventilator = None
         self._get_results_worker_id = 0
+        # Results are read from the workers' results queues in a strict round robin order, unless there is a single
+        # worker (its results are already in order) or shuffle_rows is enabled and the seed is not set (we don't care
+        # about the order). In these cases all workers publish their results into a single shared queue
+        self._round_robin_results = workers_count > 1 and not (shuffle_rows and (seed is None or seed == 0))
+        self._shared_results_queue = None
+        # Set by the workers whenever a result is published. Used by get_results to wait for the current worker
+        self._results_published = Event()
+        self._stolen_results = []
 
     def start(self, worker_class, worker_args=None, ventilator=None):
         """Starts worker threads.
@@ -120,22 +172,33 @@ class ThreadPool(object):
             raise RuntimeError('ThreadPool({}) cannot be reused! stop_event set? {}'
                                .format(len(self._workers), self._stop_event.is_set()))
 
-        # Set up a channel for each worker to send work
-        self._ventilator_queues = [queue.Queue() for _ in range(self.workers_count)]
-        # Set up a channel for each worker to send results
-        self._results_queues = [
-            queue.Queue(max(5, self._results_queue_size // self.workers_count))
-            for _ in range(self.workers_count)
-        ]
+        # Set up a channel for each worker to send work. Each channel has a single producer (the thread calling
+        # ventilate) and a single consumer (the worker), so we can use a lock-free SPSC queue.
+        self._ventilator_queues = [SPSCQueue() for _ in range(self.workers_count)]
+        if self._round_robin_results:
+            # Set up a channel for each worker to send results. The worker is the only producer and the thread calling
+            # get_results is the only consumer.
+            self._results_queues = [
+                SPSCQueue(max(5, self._results_queue_size // self.workers_count))
+                for _ in range(self.workers_count)
+            ]
+            # Results taken out of the results queues of workers other than the current one (see
+            # _wait_for_round_robin_result)
+            self._stolen_results = [deque() for _ in range(self.workers_count)]
+        elif self.workers_count == 1:
+            # The worker writes directly into the shared queue and is its only producer
+            self._shared_results_queue = SPSCQueue(max(5, self._results_queue_size))
+            self._results_queues = [self._shared_results_queue]
+        else:
+            # Order does not matter: all workers write directly into the same queue
+            self._shared_results_queue = MPSCQueue(self._results_queue_size)
+            self._results_queues = [self._shared_results_queue] * self.workers_count
         self._workers = []
         for worker_id in range(self.workers_count):
-            # Create a closure that captures the worker_id for this specific worker
-            def make_publish_func(worker_id):
-                return lambda data: self._stop_aware_put(worker_id, data)
-
-            worker_impl = worker_class(worker_id, make_publish_func(worker_id), worker_args)
+            worker_impl = worker_class(worker_id, self._make_publish_func(worker_id), worker_args)
+            cpu = self._pin_to_cpus[worker_id % len(self._pin_to_cpus)] if self._pin_to_cpus else None
             new_thread = WorkerThread(worker_impl, self._stop_event, self._ventilator_queues[worker_id],
-                                      self._results_queues[worker_id], self._profiling_enabled)
+                                      self._profiling_enabled, cpu)
             # Make the thread daemonic. Since it only reads it's ok to abort while running - no resource corruption
             # will occur.
             new_thread.daemon = True
@@ -147,6 +210,7 @@ class ThreadPool(object):
 
         if ventilator:
             self._ventilator = ventilator
+            self._ventilator.set_completion_callback(self._on_ventilation_completed)
             self._ventilator.start()
 
     def ventilate(self, *args, **kargs):
@@ -155,19 +219,28 @@ class ThreadPool(object):
         current_worker_id = self._ventilated_items % self.workers_count
         self._ventilated_items += 1
         self._ventilated_items_by_worker[current_worker_id] += 1
-        self._ventilator_queues[current_worker_id].put((args, kargs))
+        # Keyword arguments only are queued as is (no (args, kargs) tuple), see WorkerThread.run
+        self._ventilator_queues[current_worker_id].put((args, kargs) if args else kargs)
 
-    def current_worker_done(self, worker_id):
-        # Check if the current worker has processed all the items it was assigned and if the results queue is empty
-        return (self._ventilated_items_processed_by_worker[worker_id] == self._ventilated_items_by_worker[worker_id]
-                and self._results_queues[worker_id].empty())
+    def ventilate_many(self, items):
+        """Sends a batch of work items to the workers. Equivalent to calling ``ventilate(**item)`` for each item in
+        ``items``, but each worker's queue is extended only once.
+
+        :param items: (``list[dict]``) Each item is a ``dict`` denoting the ``**kwargs`` passed to ``worker.process``.
+        """
+        first_worker_id = self._ventilated_items % self.workers_count
+        self._ventilated_items += len(items)
+        for worker_id in range(self.workers_count):
+            # items[j] goes to worker (first_worker_id + j) % workers_count, so each worker's share is a strided slice
+            shard = items[(worker_id - first_worker_id) % self.workers_count::self.workers_count]
+            if shard:
+                self._ventilated_items_by_worker[worker_id] += len(shard)
+                self._ventilator_queues[worker_id].put_many(shard)
 
     def all_workers_done(self):
-        # Check if all workers have processed all the items they were assigned and if the results queues are empty
-        for i in range(self.workers_count):
-            if not self.current_worker_done(i):
-                return False
-        return True
+        # A worker publishes VentilatedItemProcessedMessage after all the results of an item, so once get_results
+        # consumed the message for every ventilated item, the results queues are empty as well
+        return self._ventilated_items == self._ventilated_items_processed
 
     def get_results(self):
         """Returns results from worker pool or re-raise worker's exception if any happen in worker thread.
@@ -178,56 +251,128 @@ class ThreadPool(object):
         :return: arguments passed to ``publish_func(...)`` by a worker. If no more results are anticipated,
                  :class:`.EmptyResultError`.
         """
-        # If shuffle_rows is enabled and the seed is not set, we need to use a non-blocking
-        #  as we don't care about the strict round robin order
-        use_non_blocking_get = self._shuffle_rows and (self._seed is None or self._seed == 0)
         while True:
-            # If there is no more work to do, raise an EmptyResultError
-            if self.all_workers_done():
-                # We also need to check if we are using a ventilator and if it is completed
-                if not self._ventilator or self._ventilator.completed():
+            # The pool might have been stopped from another thread
+            if self._stop_event.is_set():
+                raise EmptyResultError()
+
+            if self._round_robin_results:
+                result = self._next_round_robin_result()
+            else:
+                result = self._next_shared_queue_result()
+
+            # If the result is a VentilatedItemProcessedMessage, we need to increment the count of items processed
+            if result is _VENTILATED_ITEM_PROCESSED:
+                self._ventilated_items_processed += 1
+                if self._ventilator:
+                    self._ventilator.processed_item()
+            elif isinstance(result, Exception):
+                self.stop()
+                self.join()
+                raise result
+            else:
+                return result
+
+    def _next_round_robin_result(self):
+        """Blocks on the results queue of the current worker (strict round robin order).
+
+        Items are assigned to workers in a round robin order, so if the current worker has no unprocessed items, all
+        ventilated items were consumed and the next ventilated item will be assigned to the current worker.
+        """
+        worker_id = self._get_results_worker_id
+        stolen_results = self._stolen_results[worker_id]
+        while True:
+            timeout = None
+            if self._ventilated_items_processed_by_worker[worker_id] == self._ventilated_items_by_worker[worker_id]:
+                # All ventilated items were consumed. No more items are ventilated once the ventilator completed,
+                # hence the counters are checked again after reading the completion state. Otherwise, we wait for the
+                # next item to be ventilated (to this worker) or for _EOF.
+                ventilation_completed = not self._ventilator or self._ventilator.completed()
+                if (ventilation_completed and self._ventilated_items_processed_by_worker[worker_id] ==
+                        self._ventilated_items_by_worker[worker_id]):
                     raise EmptyResultError()
+                timeout = _VERIFY_END_OF_VENTILATION_PERIOD
+            if stolen_results:
+                result = stolen_results.popleft()
+            else:
+                result = self._wait_for_round_robin_result(worker_id, timeout)
+            if result is not _EOF:
+                break
 
-            # If the current worker is done, we need to get the result from the next worker
-            if self.current_worker_done(self._get_results_worker_id):
-                self._get_results_worker_id = (self._get_results_worker_id + 1) % self.workers_count
-                continue
+        if result is _VENTILATED_ITEM_PROCESSED:
+            self._ventilated_items_processed_by_worker[worker_id] += 1
+            # Move to the next worker
+            self._get_results_worker_id = (worker_id + 1) % self.workers_count
+        return result
 
+    def _wait_for_round_robin_result(self, worker_id, timeout=None):
+        """Blocks until ``worker_id`` publishes its next result. Returns ``_EOF`` if no result was published by any
+        worker within ``timeout`` seconds (``None`` waits forever).
+
+        While waiting on a slow worker, the results already published by the other workers are moved into local
+        buffers (up to the results queue size per worker), so these workers are not blocked on a full results queue
+        and keep processing their next items. The per-worker FIFO order, and hence the round robin order, is kept.
+        """
+        results_queue = self._results_queues[worker_id]
+        while True:
+            # Clear before checking the queue so a result published in between is not missed
+            self._results_published.clear()
             try:
-                # Get the result from the current worker's results queue.
-                # Use blocking/strict round robin if shuffle_rows is disabled or the seed is set
-                result = self._results_queues[self._get_results_worker_id].get(
-                    block=not use_non_blocking_get, timeout=_VERIFY_END_OF_VENTILATION_PERIOD
-                )
-                # If the result is a VentilatedItemProcessedMessage, we need to increment the count of items
-                # processed by the current worker
-                if isinstance(result, VentilatedItemProcessedMessage):
-                    self._ventilated_items_processed_by_worker[self._get_results_worker_id] += 1
-                    if self._ventilator:
-                        self._ventilator.processed_item()
-                    # Move to the next worker
-                    self._get_results_worker_id = (self._get_results_worker_id + 1) % self.workers_count
+                return results_queue.get(block=False)
+            except queue.Empty:
+                pass
+            for other_worker_id, other_queue in enumerate(self._results_queues):
+                if other_worker_id == worker_id:
                     continue
-                elif isinstance(result, Exception):
-                    self.stop()
-                    self.join()
-                    raise result
-                else:
-                    return result
+                stolen_results = self._stolen_results[other_worker_id]
+                while len(stolen_results) < other_queue.maxsize:
+                    try:
+                        stolen_results.append(other_queue.get(block=False))
+                    except queue.Empty:
+                        break
+            # stop() sets _results_published after setting the stop event
+            if self._stop_event.is_set():
+                raise EmptyResultError()
+            if not self._results_published.wait(timeout):
+                return _EOF
+
+    def _next_shared_queue_result(self):
+        """Blocks on the shared results queue all the workers publish to."""
+        while True:
+            timeout = None
+            if self.all_workers_done():
+                # Same as in _next_round_robin_result: check the counters again after reading the completion state
+                ventilation_completed = not self._ventilator or self._ventilator.completed()
+                if ventilation_completed and self.all_workers_done():
+                    raise EmptyResultError()
+                timeout = _VERIFY_END_OF_VENTILATION_PERIOD
+            try:
+                result = self._shared_results_queue.get(timeout=timeout)
             except queue.Empty:
                 continue
+            if result is _STOP:
+                raise EmptyResultError()
+            if result is not _EOF:
+                return result
 
     def stop(self):
         """Stops all workers (non-blocking)."""
         if self._ventilator:
             self._ventilator.stop()
         self._stop_event.set()
+        for ventilator_queue in self._ventilator_queues:
+            ventilator_queue.put(_STOP)
+        # Wake up get_results if it is blocked in another thread
+        self._results_published.set()
+        self._drain_results_queues()
 
     def join(self):
         """Block until all workers are terminated."""
         for w in self._workers:
-            if w.is_alive():
-                w.join()
+            while w.is_alive():
+                # The worker might be blocked publishing to a full results queue
+                self._drain_results_queues()
+                w.join(IO_TIMEOUT_INTERVAL_S)
 
         if self._profiling_enabled:
             # If we have profiling set, collect stats and print them
@@ -239,25 +384,80 @@ class ThreadPool(object):
                     stats = pstats.Stats(w.prof)
             stats.sort_stats('cumulative').print_stats()
 
-    def _stop_aware_put(self, worker_id, data):
-        """This method is called to write the results to the results queue. We use ``put`` in a non-blocking way so we
-        can gracefully terminate the worker thread without being stuck on :func:`Queue.put`.
-
-        The method raises :class:`.WorkerTerminationRequested` exception that should be passed through all the way up to
-        :func:`WorkerThread.run` which will gracefully terminate main worker loop."""
-        while True:
+    def _drain_results_queues(self):
+        """Discards the published results once the pool was stopped, so workers blocked in :func:`_stop_aware_put` on a
+        full results queue return and terminate."""
+        for results_queue in self._results_queues:
+            try:
+                while True:
+                    results_queue.get(block=False)
+            except queue.Empty:
+                pass
+        if self._shared_results_queue is not None:
+            # Wake up get_results if it is blocked on the shared results queue in another thread. If the queue is full
+            # again, get_results is not blocked on it and will see the stop event on its next call. This is an
+            # out-of-band put, which SPSCQueue allows as long as it does not block.
             try:
-                self._results_queues[worker_id].put(data, block=True, timeout=IO_TIMEOUT_INTERVAL_S)
-                return
+                self._shared_results_queue.put(_STOP, block=False)
             except queue.Full:
                 pass
 
-            if self._stop_event.is_set():
-                raise WorkerTerminationRequested()
+    def _on_ventilation_completed(self):
+        """Called on the ventilator thread once the ventilator completes. Wakes up get_results in case it waits for
+        more items to be ventilated."""
+        if self._round_robin_results:
+            # Items are ventilated round robin, so the consumer waits on the worker the next item would go to
+            results_queue = self._results_queues[self._ventilated_items % self.workers_count]
+        else:
+            results_queue = self._shared_results_queue
+        # An out-of-band put from the ventilator thread, which SPSCQueue allows as long as it does not block
+        try:
+            results_queue.put(_EOF, block=False)
+        except queue.Full:
+            # get_results is not blocked on a full queue and will find out the ventilator has completed by itself
+            pass
+        self._results_published.set()
+
+    def _make_publish_func(self, worker_id):
+        """Creates the ``publish_func`` for a worker. The worker's results queue is bound once here rather than looked
+        up on every published result."""
+        results_queue = self._results_queues[worker_id]
+        return lambda data: self._stop_aware_put(results_queue, data)
+
+    def _stop_aware_put(self, results_queue, data):
+        """This method is called to write the results to the results queue. ``put`` blocks while the results queue is
+        full: once the pool is stopped, :func:`stop` and :func:`join` drain the results queues so the worker thread is
+        not stuck on it.
+
+        The method raises :class:`.WorkerTerminationRequested` exception if the pool was stopped. It should be passed
+        through all the way up to :func:`WorkerThread.run` which will gracefully terminate main worker loop."""
+        if self._stop_event.is_set():
+            raise WorkerTerminationRequested()
+        results_queue.put(data)
+        if not self._results_published.is_set():
+            self._results_published.set()
 
     def results_qsize(self):
-        return sum(queue.qsize() for queue in self._results_queues)
+        if self._shared_results_queue is not None:
+            return self._shared_results_queue.qsize()
+        return (sum(queue.qsize() for queue in self._results_queues) +
+                sum(len(stolen_results) for stolen_results in self._stolen_results))
 
     @property
     def diagnostics(self):
-        return {'output_queue_size': self.results_qsize()}
+        # A snapshot read without synchronizing with the workers, so the values are cheap to collect but might be
+        # slightly off while the pool is running. items_produced is updated only when get_results consumes the
+        # VentilatedItemProcessedMessage of an item, so its value may lag.
+        diagnostics = {
+            'output_queue_size': self.results_qsize(),
+            'items_consumed': self._ventilated_items,
+            'items_produced': self._ventilated_items_processed,
+            'items_inprocess': self._ventilated_items - self._ventilated_items_processed,
+            'per_worker_pending': [ventilator_queue.qsize() for ventilator_queue in self._ventilator_queues],
+        }
+        if self._round_robin_results:
+            # Results are read from a results queue per worker (shared results queue otherwise)
+            diagnostics['per_worker_ready'] = [results_queue.qsize() + len(stolen_results)
+                                               for results_queue, stolen_results
+                                               in zip(self._results_queues, self._stolen_results)]
+        return diagnostics
@@ -15,7 +15,6 @@
 import numpy as np
 import threading
 from abc import ABCMeta, abstractmethod
-from time import sleep
 
 import six
 
@@ -28,6 +27,14 @@ class Ventilator(object):
 
     def __init__(self, ventilate_fn):
         self._ventilate_fn = ventilate_fn
+        self._completion_callback = None
+
+    def set_completion_callback(self, completion_callback):
+        """Registers a function to be called once the ventilator stops ventilating items (either all the items were
+        ventilated or :func:`stop` was called). A worker pool may use it to wake up a consumer waiting for more
+        items right away. Calling it is optional for ventilator implementations: a worker pool must still find out about
+        the completion by polling :func:`completed`."""
+        self._completion_callback = completion_callback
 
     @abstractmethod
     def start(self):
@@ -68,7 +75,8 @@ class ConcurrentVentilator(Ventilator):
                  randomize_item_order=False,
                  random_seed=None,
                  max_ventilation_queue_size=None,
-                 ventilation_interval=_VENTILATION_INTERVAL):
+                 ventilation_interval=_VENTILATION_INTERVAL,
+                 ventilate_many_fn=None):
         """
         Constructor for a concurrent ventilator.
 
@@ -85,9 +93,14 @@ class ConcurrentVentilator(Ventilator):
                 The higher this number, the higher potential memory requirements. By default it will use the size
                 of items_to_ventilate since that can definitely be held in memory.
         :param ventilation_interval: (``float`` in seconds) How much time passes between checks on whether something
-                can be ventilated (when the ventilation queue is considered full).
+                can be ventilated (when the ventilation queue is considered full). The ventilation thread is woken up
+                earlier once an item is processed.
+        :param ventilate_many_fn: Optional function that ventilates a list of items in a single call (usually the
+                worker pool ``ventilate_many`` function). If set, all the items that fit into the ventilation queue are
+                handed to the worker pool at once instead of calling ``ventilate_fn`` for each of them.
         """
         super(ConcurrentVentilator, self).__init__(ventilate_fn)
+        self._ventilate_many_fn = ventilate_many_fn
 
         if iterations is not None and (not isinstance(iterations, int) or iterations < 1):
             raise ValueError('iterations must be positive integer or None')
@@ -111,6 +124,9 @@ class ConcurrentVentilator(Ventilator):
         self._ventilated_items_count = 0
         self._processed_items_count = 0
         self._stop_requested = False
+        # Set when a ventilated item is processed (or stop is requested), to wake up the ventilation thread waiting
+        # for room in the ventilation queue
+        self._room_available = threading.Event()
 
     def start(self):
         # Start the ventilation thread
@@ -120,6 +136,8 @@ class ConcurrentVentilator(Ventilator):
 
     def processed_item(self):
         self._processed_items_count += 1
+        if not self._room_available.is_set():
+            self._room_available.set()
 
     def completed(self):
         assert self._iterations_remaining is None or self._iterations_remaining >= 0
@@ -137,14 +155,16 @@ class ConcurrentVentilator(Ventilator):
         self.start()
 
     def _ventilate(self):
-        # Randomize the item order before starting the ventilation if randomize_item_order is set
+        # Randomize the item order before starting the ventilation if randomize_item_order is set. We permute item
+        # indices rather than the items: permuting a list of dicts would go through a numpy object array.
         if self._randomize_item_order:
             if self._random_seed is not None and self._random_seed != 0:
                 # Deterministic randomization: use provided seed
-                self._items_to_ventilate = list(self._rng.permutation(self._items_to_ventilate))
+                order = self._rng.permutation(len(self._items_to_ventilate))
             else:
                 # Non-deterministic randomization: use np.random
-                self._items_to_ventilate = list(np.random.permutation(self._items_to_ventilate))
+                order = np.random.permutation(len(self._items_to_ventilate))
+            self._items_to_ventilate = [self._items_to_ventilate[i] for i in order]
 
         while True:
             # Stop condition is when no iterations are remaining or there are no items to ventilate
@@ -152,14 +172,25 @@ class ConcurrentVentilator(Ventilator):
                 break
 
             # Block until queue has room, but use continue to allow for checking if stop has been called
-            if self._ventilated_items_count - self._processed_items_count >= self._max_ventilation_queue_size:
-                sleep(self._ventilation_interval)
+            room = self._max_ventilation_queue_size - (self._ventilated_items_count - self._processed_items_count)
+            if room <= 0:
+                # Clear before checking the counters again so an item processed in between is not missed
+                self._room_available.clear()
+                if self._ventilated_items_count - self._processed_items_count >= self._max_ventilation_queue_size:
+                    self._room_available.wait(self._ventilation_interval)
                 continue
 
-            item_to_ventilate = self._items_to_ventilate[self._current_item_to_ventilate]
-            self._ventilate_fn(**item_to_ventilate)
-            self._current_item_to_ventilate += 1
-            self._ventilated_items_count += 1
+            if self._ventilate_many_fn:
+                # Ventilate everything that fits into the queue, up to the end of the current iteration
+                end = min(len(self._items_to_ventilate), self._current_item_to_ventilate + room)
+                self._ventilate_many_fn(self._items_to_ventilate[self._current_item_to_ventilate:end])
+                ventilated_count = end - self._current_item_to_ventilate
+            else:
+                item_to_ventilate = self._items_to_ventilate[self._current_item_to_ventilate]
+                self._ventilate_fn(**item_to_ventilate)
+                ventilated_count = 1
+            self._current_item_to_ventilate += ventilated_count
+            self._ventilated_items_count += ventilated_count
 
             if self._current_item_to_ventilate >= len(self._items_to_ventilate):
                 self._current_item_to_ventilate = 0
@@ -167,8 +198,12 @@ class ConcurrentVentilator(Ventilator):
                 if self._iterations_remaining is not None:
                     self._iterations_remaining -= 1
 
+        if self._completion_callback:
+            self._completion_callback()
+
     def stop(self):
         self._stop_requested = True
+        self._room_available.set()
         if self._ventilation_thread:
             self._ventilation_thread.join()
             self._ventilation_thread = None